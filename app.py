@@ -1,15 +1,33 @@
 #!/usr/bin/env python3
 import os
 
-import aws_cdk as cdk
+# skip capturing a JS stack trace for every construct's metadata during synth
+os.environ.setdefault("CDK_DISABLE_STACK_TRACE", "1")
 
-from lib.stacks import MercuryCodeBuild, MercuryStack
+import aws_cdk as cdk  # noqa: E402
 
-app = cdk.App()
+from lib.stacks import MercuryCodeBuild, MercuryStack  # noqa: E402
+
+app = cdk.App(context={"aws:cdk:disable-stack-trace": "true"})
 env = cdk.Environment(
     account=os.environ["CDK_DEFAULT_ACCOUNT"], region=os.environ["CDK_DEFAULT_REGION"]
 )
-codebuild = MercuryCodeBuild(app, "MercuryCodeBuild", env=env)
-MercuryStack(app, "MercuryStack", artifacts_bucket=codebuild.bucket, env=env)
+
+# only build the requested stacks, e.g. `cdk synth -c stacks=MercuryStack`
+stacks = app.node.try_get_context("stacks")
+selected = set(stacks.split(",")) if stacks else {"MercuryCodeBuild", "MercuryStack"}
+
+codebuild = None
+if "MercuryCodeBuild" in selected:
+    codebuild = MercuryCodeBuild(app, "MercuryCodeBuild", env=env)
+if "MercuryStack" in selected:
+    mercury = MercuryStack(
+        app,
+        "MercuryStack",
+        artifacts_bucket_arn=cdk.Fn.import_value(MercuryCodeBuild.ARTIFACTS_BUCKET_EXPORT),
+        env=env,
+    )
+    if codebuild:
+        mercury.add_dependency(codebuild)
 
 app.synth()
@@ -0,0 +1,10 @@
+FLUENT_BIT_VERSION = "2.1.8"
+
+# arm64 fluent-bit rpm mirrored into the artifacts bucket by the mercury arm build
+FLUENT_BIT_RPM_KEY = f"fluent-bit/fluent-bit-{FLUENT_BIT_VERSION}-1.aarch64.rpm"
+
+# add the upstream fluent-bit yum repo on amazon linux 2
+FLUENT_BIT_REPO_COMMANDS = (
+    "rpm --import https://packages.fluentbit.io/fluentbit.key",
+    "yum-config-manager --add-repo 'https://packages.fluentbit.io/amazonlinux/2/$basearch/'",
+)
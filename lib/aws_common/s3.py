@@ -4,6 +4,14 @@ from aws_cdk import RemovalPolicy
 from aws_cdk.aws_s3 import BlockPublicAccess, Bucket, BucketEncryption
 from constructs import Construct
 
+_SECURE_DEFAULTS = {
+    "block_public_access": BlockPublicAccess.BLOCK_ALL,
+    "encryption": BucketEncryption.S3_MANAGED,
+    "enforce_ssl": True,
+    "versioned": True,
+    "removal_policy": RemovalPolicy.RETAIN,
+}
+
 
 class SecureBucket(Bucket):
     def __init__(
@@ -13,10 +21,6 @@ class SecureBucket(Bucket):
             scope,
             bucket_id,
             bucket_name=bucket_name or bucket_id,
-            block_public_access=BlockPublicAccess.BLOCK_ALL,
-            encryption=BucketEncryption.S3_MANAGED,
-            enforce_ssl=True,
-            versioned=True,
-            removal_policy=RemovalPolicy.RETAIN,
+            **_SECURE_DEFAULTS,
             **kwargs,
         )
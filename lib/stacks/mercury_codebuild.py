@@ -1,31 +1,122 @@
-from typing import Dict, List
+from functools import cached_property
+from typing import TYPE_CHECKING, Any, Dict, List
 
-from aws_cdk import Duration, Stack
+from aws_cdk import CfnOutput, Duration, Stack
 from aws_cdk.aws_codebuild import (
     Artifacts,
     BuildEnvironment,
+    BuildEnvironmentVariable,
     BuildSpec,
-    Cache,
     ComputeType,
     LinuxBuildImage,
-    LocalCacheMode,
     Project,
     Source,
 )
-from aws_cdk.aws_events import Rule, Schedule
-from aws_cdk.aws_events_targets import CodeBuildProject
+from aws_cdk.aws_iam import PolicyStatement
 from aws_cdk.aws_s3 import LifecycleRule, StorageClass, Transition
 from constructs import Construct
 
+from lib.aws_common.fluent_bit import (
+    FLUENT_BIT_REPO_COMMANDS,
+    FLUENT_BIT_RPM_KEY,
+    FLUENT_BIT_VERSION,
+)
 from lib.aws_common.s3 import SecureBucket
 
+if TYPE_CHECKING:
+    from aws_cdk.aws_events import Rule
+
+__all__ = ["MercuryCodeBuild"]
+
+_YUM_DEPS = (
+    "gcc10",
+    "gcc10-c++",
+    "zlib-devel",
+    "openssl-devel",
+    "kernel-devel",
+    "autoconf",
+    "libasan10",
+    "rpm-build",
+    "squashfs-tools",
+    "yum-utils",
+)
+
+# batch builds share one project cache, so each arch keeps its ccache in its own s3 prefix
+_CCACHE_S3_URI = "s3://$ARTIFACTS_BUCKET/codebuild-cache/$BUILD_ARCH/"
+
+_BUILD_SPEC = {
+    "version": "0.2",
+    "env": {
+        "variables": {
+            "CC": "/usr/bin/gcc10-gcc",
+            "CXX": "/usr/bin/gcc10-c++",
+            "CCACHE_DIR": "/root/.ccache",
+            "CCACHE_MAXSIZE": "2G",
+        }
+    },
+    "phases": {
+        "install": {
+            "runtime-versions": {
+                "ruby": "latest",
+            },
+            "commands": [
+                "yum update -y",
+                f"yum install -y {' '.join(_YUM_DEPS)}",
+                # ccache is only packaged in the archived EPEL 7, so build without it if missing
+                # and disable the repo so later yum calls don't trip over its dead metalink
+                "(amazon-linux-extras install -y epel && yum install -y ccache)"
+                " || (yum-config-manager --disable epel; echo 'building without ccache')",
+            ],
+        },
+        "pre_build": {
+            "commands": [
+                "if command -v ccache >/dev/null; then"
+                f" aws s3 sync --only-show-errors {_CCACHE_S3_URI} $CCACHE_DIR;"
+                ' export CC="ccache $CC" CXX="ccache $CXX"; fi',
+            ]
+        },
+        "build": {
+            "commands": [
+                './configure CC="$CC" CXX="$CXX"',
+                'make CC="$CC" CXX="$CXX" V=s',
+            ],
+            # skipped without ccache so an empty local dir never --deletes the s3 copy
+            "finally": [
+                "if command -v ccache >/dev/null; then ccache --show-stats"
+                f" && aws s3 sync --only-show-errors --delete $CCACHE_DIR {_CCACHE_S3_URI}; fi",
+            ],
+        },
+        "post_build": {
+            "commands": [
+                "export MERC_VERSION=$(cat VERSION)",
+                "gem install fpm",
+                "./build_pkg.sh -t rpm",
+                # outside the source dir so it isn't collected as a mercury artifact
+                'if [ "$BUILD_ARCH" = arm ]; then '
+                + " && ".join(FLUENT_BIT_REPO_COMMANDS)
+                + f" && yumdownloader --destdir /tmp/fluent-bit fluent-bit-{FLUENT_BIT_VERSION}"
+                + " && aws s3 cp /tmp/fluent-bit/*.rpm"
+                + f" s3://$ARTIFACTS_BUCKET/{FLUENT_BIT_RPM_KEY}; fi",
+            ]
+        },
+    },
+    "artifacts": {
+        "files": ["*.rpm"],
+        "discard-paths": "yes",
+        "name": "mercury-package",
+    },
+}
+
 
 class MercuryCodeBuild(Stack):
+    ARTIFACTS_BUCKET_EXPORT = "MercuryArtifactsBucketArn"
+
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         self.bucket = self.build_artifacts_bucket()
-        self.projects = self.build_projects()
+        self.bucket_output = self.build_artifacts_bucket_output()
+        self.project = self.build_project()
         self.rule = self.build_project_rule()
 
     def build_artifacts_bucket(self) -> SecureBucket:
@@ -45,90 +136,93 @@ class MercuryCodeBuild(Stack):
             ],
         )
 
-    def build_project_rule(self) -> Rule:
+    def build_artifacts_bucket_output(self) -> CfnOutput:
+        """Export artifacts bucket ARN so consumers don't need this stack in the same synth
+
+        The export_value() call keeps the export CDK generated for the old construct reference,
+        which an existing MercuryStack still imports. It can be dropped after all environments
+        have deployed MercuryStack with artifacts_bucket_arn.
+        """
+        self.export_value(self.bucket.bucket_arn)
+        return CfnOutput(
+            self,
+            self.ARTIFACTS_BUCKET_EXPORT,
+            value=self.bucket.bucket_arn,
+            export_name=self.ARTIFACTS_BUCKET_EXPORT,
+        )
+
+    def build_project_rule(self) -> "Rule":
+        # only needed for this rule, so keep out of the module import path
+        from aws_cdk.aws_events import Rule, Schedule
+        from aws_cdk.aws_events_targets import AwsApi
+
+        # the codebuild target can only StartBuild, which ignores the batch build-list
         return Rule(
             self,
             "MercuryCodeBuildRule",
             rule_name="mercury-codebuild-rule",
             schedule=Schedule.rate(Duration.days(7)),
-            targets=[CodeBuildProject(proj) for proj in self.projects],
+            targets=[
+                AwsApi(
+                    service="CodeBuild",
+                    action="startBuildBatch",
+                    parameters={"projectName": self.project.project_name},
+                    policy_statement=PolicyStatement(
+                        actions=["codebuild:StartBuildBatch"],
+                        resources=[self.project.project_arn],
+                    ),
+                )
+            ],
         )
 
-    def build_projects(self) -> List[Project]:
-        environments: Dict[str, LinuxBuildImage] = {
-            "x86": LinuxBuildImage.AMAZON_LINUX_2_4,
-            "arm": LinuxBuildImage.AMAZON_LINUX_2_ARM_2,
-        }
+    def build_project(self) -> Project:
+        project = Project(
+            self,
+            "MercuryProject",
+            build_spec=self.build_spec,
+            source=self.source,
+            environment=BuildEnvironment(
+                build_image=LinuxBuildImage.AMAZON_LINUX_2_4, compute_type=ComputeType.SMALL
+            ),
+            environment_variables={
+                "ARTIFACTS_BUCKET": BuildEnvironmentVariable(value=self.bucket.bucket_name)
+            },
+            project_name="mercury-codebuild",
+            artifacts=Artifacts.s3(
+                bucket=self.bucket,
+                include_build_id=False,
+                package_zip=False,
+            ),
+        )
+        # each architecture is an entry in the buildspec build-list
+        project.enable_batch_builds()
+        self.bucket.grant_read_write(project)
+        return project
 
-        projects = []
-        for arch, image in environments.items():
-            proj = Project(
-                self,
-                f"MercuryProject{arch.capitalize()}",
-                build_spec=self.build_spec,
-                source=self.source,
-                concurrent_build_limit=1,
-                environment=BuildEnvironment(build_image=image, compute_type=ComputeType.SMALL),
-                project_name=f"mercury-codebuild-{arch}",
-                cache=Cache.local(LocalCacheMode.SOURCE),
-                artifacts=Artifacts.s3(
-                    bucket=self.bucket,
-                    include_build_id=False,
-                    package_zip=False,
-                ),
-            )
-            projects.append(proj)
-        return projects
-
-    @property
+    @cached_property
     def source(self) -> Source:
         return Source.git_hub(owner="cisco", repo="mercury", clone_depth=1)
 
-    @property
-    def build_spec(self) -> BuildSpec:
-        yum_deps = [
-            "gcc10",
-            "gcc10-c++",
-            "zlib-devel",
-            "openssl-devel",
-            "kernel-devel",
-            "autoconf",
-            "libasan10",
-            "rpm-build",
-            "squashfs-tools",
-        ]
-        return BuildSpec.from_object(
+    @cached_property
+    def build_list(self) -> List[Dict[str, Any]]:
+        """One batch build per architecture, resolved at synth rather than module import"""
+        images = {
+            "x86": LinuxBuildImage.AMAZON_LINUX_2_4,
+            "arm": LinuxBuildImage.AMAZON_LINUX_2_ARM_2,
+        }
+        return [
             {
-                "version": "0.2",
-                "env": {"variables": {"CC": "/usr/bin/gcc10-gcc", "CXX": "/usr/bin/gcc10-c++"}},
-                "phases": {
-                    "install": {
-                        "runtime-versions": {
-                            "ruby": "latest",
-                        },
-                        "commands": [
-                            "yum update -y",
-                            f"yum install -y {' '.join(yum_deps)}",
-                        ],
-                    },
-                    "build": {
-                        "commands": [
-                            "./configure CC=$CC CXX=$CXX",
-                            "make CC=$CC CXX=$CXX V=s",
-                        ]
-                    },
-                    "post_build": {
-                        "commands": [
-                            "export MERC_VERSION=$(cat VERSION)",
-                            "gem install fpm",
-                            "./build_pkg.sh -t rpm",
-                        ]
-                    },
-                },
-                "artifacts": {
-                    "files": ["*.rpm"],
-                    "discard-paths": "yes",
-                    "name": "mercury-package",
+                "identifier": arch,
+                "env": {
+                    "variables": {"BUILD_ARCH": arch},
+                    "type": image.type,
+                    "image": image.image_id,
+                    "compute-type": ComputeType.SMALL.value,
                 },
             }
-        )
+            for arch, image in images.items()
+        ]
+
+    @cached_property
+    def build_spec(self) -> BuildSpec:
+        return BuildSpec.from_object({**_BUILD_SPEC, "batch": {"build-list": self.build_list}})
@@ -1,6 +1,8 @@
 from functools import cached_property
+from textwrap import dedent
+from typing import TYPE_CHECKING
 
-from aws_cdk import Duration, Stack
+from aws_cdk import Duration, Size, Stack
 from aws_cdk.aws_autoscaling import (
     ApplyCloudFormationInitOptions,
     AutoScalingGroup,
@@ -14,8 +16,10 @@ from aws_cdk.aws_ec2 import (
     AmazonLinuxKernel,
     CloudFormationInit,
     InitCommand,
+    InitConfig,
     InitFile,
-    InitPackage,
+    InitService,
+    InitServiceRestartHandle,
     InstanceType,
     MachineImage,
     Peer,
@@ -27,33 +31,47 @@ from aws_cdk.aws_ec2 import (
     Vpc,
 )
 from aws_cdk.aws_iam import PolicyStatement
-from aws_cdk.aws_kinesisfirehose_alpha import DeliveryStream
-from aws_cdk.aws_kinesisfirehose_destinations_alpha import Compression, S3Bucket
-from aws_cdk.aws_s3 import Bucket
-from aws_cdk.aws_s3_deployment import BucketDeployment, Source
+from aws_cdk.aws_s3 import Bucket, IBucket, LifecycleRule, StorageClass, Transition
+from aws_cdk.aws_s3_assets import Asset
 from constructs import Construct
 
 from lib.aws_common.ec2 import build_security_group
+from lib.aws_common.fluent_bit import (
+    FLUENT_BIT_REPO_COMMANDS,
+    FLUENT_BIT_RPM_KEY,
+    FLUENT_BIT_VERSION,
+)
 from lib.aws_common.s3 import SecureBucket
 
+if TYPE_CHECKING:
+    from aws_cdk.aws_kinesisfirehose_alpha import DeliveryStream
+
+__all__ = ["MercuryStack"]
+
+# internet-facing ports whose tls and http client traffic mercury fingerprints
+_SENSOR_TCP_PORTS = (80, 443)
+
+# first fingerprint protocol of a mercury record (tls, http, ...), used as a partition key
+_FINGERPRINT_TYPE_QUERY = '{fp_type: (.fingerprints // {} | keys_unsorted | .[0] // "none")}'
+
 
 class MercuryStack(Stack):
     def __init__(
-        self, scope: Construct, construct_id: str, artifacts_bucket: SecureBucket, **kwargs
+        self, scope: Construct, construct_id: str, artifacts_bucket_arn: str, **kwargs
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
         self.name = "Mercury"
 
         # build s3 buckets
         self.datalake_bucket = self.build_datalake_bucket()
-        self.artifacts_bucket = artifacts_bucket
+        self.artifacts_bucket = self.import_artifacts_bucket(artifacts_bucket_arn)
 
         # build firehose
         self.firehose = self.build_firehose_stream()
 
         # build autoscaling group
         self.asg = self.build_asg()
-        artifacts_bucket.grant_read(self.asg)
+        self.artifacts_bucket.grant_read(self.asg)
         self.firehose.grant_put_records(self.asg)
 
     @cached_property
@@ -68,10 +86,12 @@ class MercuryStack(Stack):
                     cidr_mask=24,
                 )
             ],
-            max_azs=3,
+            max_azs=2,
+            # public subnets only, so nothing needs a NAT gateway
+            nat_gateways=0,
         )
 
-    @property
+    @cached_property
     def cw_metric_write_statement(self) -> PolicyStatement:
         """CloudWatch metric write statement for ec2 instance"""
         return PolicyStatement(
@@ -94,13 +114,15 @@ class MercuryStack(Stack):
             security_group=self.sensor_security_group,
             # set a spot price to keep costs low
             spot_price="0.007",
+            user_data=self.mercury_user_data,
             init=self.instance_init_config,
             signals=Signals.wait_for_all(timeout=Duration.minutes(15)),
         )
         asg.add_to_role_policy(self.cw_metric_write_statement)
+        self.sensor_setup_asset.grant_read(asg)
         return asg
 
-    @property
+    @cached_property
     def mercury_machine_image(self) -> MachineImage:
         return MachineImage.latest_amazon_linux(
             generation=AmazonLinuxGeneration.AMAZON_LINUX_2,
@@ -109,83 +131,172 @@ class MercuryStack(Stack):
 
         )
 
-    @property
+    @cached_property
     def instance_init_config(self) -> CloudFormationInit:
-        return CloudFormationInit.from_elements(
-            InitCommand.shell_command(
-                "curl https://raw.githubusercontent.com/fluent/fluent-bit/master/install.sh | sh"
-            ),
-            InitPackage.rpm("fluent-bit"),
-            InitFile.from_string("/etc/fluent-bit/fluent-bit.conf", self.fluent_bit_config),
-            InitFile.from_string("/etc/fluent-bit/parsers.conf", self.fluent_bit_parser),
+        fluent_bit_restart = InitServiceRestartHandle()
+        return CloudFormationInit.from_config_sets(
+            config_sets={"default": ["install", "config"]},
+            configs={
+                "install": InitConfig([InitCommand.shell_command(self.fluent_bit_install)]),
+                # written after the rpm install so it replaces the packaged default config
+                "config": InitConfig(
+                    [
+                        InitFile.from_string(
+                            "/etc/fluent-bit/fluent-bit.conf",
+                            self.fluent_bit_config,
+                            service_restart_handles=[fluent_bit_restart],
+                        ),
+                        InitService.enable("fluent-bit", service_restart_handle=fluent_bit_restart),
+                    ]
+                ),
+            },
         )
 
-    @property
+    @cached_property
+    def fluent_bit_install(self) -> str:
+        """Install fluent-bit from the artifacts bucket mirror, or upstream until it's mirrored"""
+        mirrored_rpm = self.artifacts_bucket.s3_url_for_object(FLUENT_BIT_RPM_KEY)
+        mirror = (
+            f"aws s3 cp --region {self.region} {mirrored_rpm} /tmp/fluent-bit.rpm"
+            " && yum install -y /tmp/fluent-bit.rpm"
+        )
+        upstream = " && ".join(
+            (*FLUENT_BIT_REPO_COMMANDS, f"yum install -y fluent-bit-{FLUENT_BIT_VERSION}")
+        )
+        return f"{{ {mirror}; }} || {{ {upstream}; }}"
+
+    @cached_property
     def fluent_bit_config(self) -> str:
-        # /etc/fluent-bit/fluent-bit.conf << EOL
-        return f"""
+        # /etc/fluent-bit/fluent-bit.conf, sections must start at column 0
+        return dedent(
+            f"""
+        [SERVICE]
+            storage.path /var/lib/fluent-bit/storage
+
         [INPUT]
             Name tail
             tag mercury.data
             Path /usr/local/var/mercury/fingerprint.json*
-            Parser json
+            Key log
+            Threaded On
+            Mem_Buf_Limit 64MB
+            Buffer_Chunk_Size 4M
+            Buffer_Max_Size 64M
+            storage.type filesystem
 
         [OUTPUT]
             Name  kinesis_firehose
             Match mercury.*
             region {self.region}
             delivery_stream {self.firehose.delivery_stream_name}
+            log_key log
+            workers 2
+            Retry_Limit False
+            storage.total_limit_size 512M
         """
+        ).lstrip()
 
-    @property
-    def fluent_bit_parser(self) -> str:
-        # /etc/fluent-bit/parsers.conf
-        return """[PARSER]
-            Name   json
-            Format json
-            Time_Key event_start
-            Time_Format %s.%6"
-        """
+    @cached_property
+    def sensor_setup_asset(self) -> Asset:
+        """Mercury install script, fetched and run by the instance user data"""
+        return Asset(self, f"{self.name}SensorSetup", path="installables/mercury_sensor_setup.sh")
 
-    @property
+    @cached_property
     def mercury_user_data(self) -> UserData:
         # TODO set this to be the latest build from codebuild
-        rpm_name = "mercury_sensor_setup.sh"
+        # fluent-bit is installed and configured by cfn-init, which runs after this script
         user_data = UserData.for_linux()
-        user_data.add_commands(
-            f'export REGION="{self.region}"',
-            f'export FIREHOSE="{self.firehose.delivery_stream_name}"',
-            f"aws s3 cp {self.artifacts_bucket.s3_url_for_object(key=rpm_name)} /tmp/{rpm_name}",
+        setup_path = user_data.add_s3_download_command(
+            bucket=self.sensor_setup_asset.bucket, bucket_key=self.sensor_setup_asset.s3_object_key
         )
-        with open("installables/mercury_sensor_setup.sh") as fp:
-            for line in fp.read().splitlines():
-                user_data.add_commands(line)
+        user_data.add_execute_file_command(file_path=setup_path)
         return user_data
 
-    @property
+    @cached_property
     def sensor_security_group(self) -> SecurityGroup:
         sg = build_security_group(self, vpc=self.vpc, name=self.name)
-        sg.add_ingress_rule(peer=Peer.any_ipv4(), connection=Port.all_traffic())
+        # sensors fingerprint traffic sent straight to them, so only expose the observed ports
+        for port in _SENSOR_TCP_PORTS:
+            sg.add_ingress_rule(peer=Peer.any_ipv4(), connection=Port.tcp(port))
         return sg
 
-    def build_firehose_stream(self) -> DeliveryStream:
-        partition = "year=!{timestamp:yyyy}/month=!{timestamp:MM}/day=!{timestamp:dd}/"
-        stream_id = f"{self.name}SensorStream"
-        return DeliveryStream(
+    def build_firehose_stream(self) -> "DeliveryStream":
+        # alpha modules are slow to import, so only load them when building the stream
+        from aws_cdk.aws_kinesisfirehose_alpha import DeliveryStream
+        from aws_cdk.aws_kinesisfirehose_destinations_alpha import Compression, S3Bucket
+
+        partition = (
+            "year=!{timestamp:yyyy}/month=!{timestamp:MM}/day=!{timestamp:dd}/hour=!{timestamp:HH}/"
+        )
+        # dynamic partitioning can only be set on create, so the partitioned stream gets a new
+        # id and name; cloudformation creates it and then deletes the unpartitioned stream
+        stream_id = f"{self.name}SensorStreamV2"
+        stream = DeliveryStream(
             self,
             stream_id,
             delivery_stream_name=stream_id,
             destinations=[
                 S3Bucket(
                     self.datalake_bucket,
-                    compression=Compression.GZIP,
-                    data_output_prefix=f"sensors/{partition}",
+                    compression=Compression.HADOOP_SNAPPY,
+                    data_output_prefix=(
+                        f"sensors/fingerprint_type=!{{partitionKeyFromQuery:fp_type}}/{partition}"
+                    ),
                     error_output_prefix=f"sensors-failures/!{{firehose:error-output-type}}/{partition}",
-                    buffering_interval=Duration.seconds(300),
+                    buffering_interval=Duration.seconds(900),
+                    buffering_size=Size.mebibytes(128),
                 )
             ],
         )
 
+        # the alpha S3 destination has no dynamic partitioning support yet
+        cfn_stream = stream.node.default_child
+        cfn_stream.add_property_override(
+            "ExtendedS3DestinationConfiguration.DynamicPartitioningConfiguration",
+            {"Enabled": True},
+        )
+        cfn_stream.add_property_override(
+            "ExtendedS3DestinationConfiguration.ProcessingConfiguration",
+            {
+                "Enabled": True,
+                "Processors": [
+                    {
+                        "Type": "MetadataExtraction",
+                        "Parameters": [
+                            {
+                                "ParameterName": "MetadataExtractionQuery",
+                                "ParameterValue": _FINGERPRINT_TYPE_QUERY,
+                            },
+                            {"ParameterName": "JsonParsingEngine", "ParameterValue": "JQ-1.6"},
+                        ],
+                    }
+                ],
+            },
+        )
+        return stream
+
+    def import_artifacts_bucket(self, bucket_arn: str) -> IBucket:
+        """Import CodeBuild artifacts bucket by ARN to avoid a construct reference across stacks"""
+        return Bucket.from_bucket_arn(self, f"{self.name}ArtifactsBucket", bucket_arn)
+
     def build_datalake_bucket(self) -> Bucket:
         """Build S3 bucket to for sensor datalake"""
-        return SecureBucket(self, bucket_id=f"{self.name.lower()}-collection-datalake")
+        return SecureBucket(
+            self,
+            bucket_id=f"{self.name.lower()}-collection-datalake",
+            lifecycle_rules=[
+                LifecycleRule(
+                    transitions=[
+                        Transition(
+                            storage_class=StorageClass.INTELLIGENT_TIERING,
+                            transition_after=Duration.days(0),
+                        )
+                    ],
+                    expiration=Duration.days(365),
+                    # the bucket is versioned, so expiration only adds a delete marker
+                    noncurrent_version_expiration=Duration.days(30),
+                ),
+                # can't be combined with expiration in the same rule
+                LifecycleRule(expired_object_delete_marker=True),
+            ],
+        )
@@ -0,0 +1,42 @@
+#!/bin/bash
+# Run read-only cdk commands against a cached cloud assembly, e.g.
+# `scripts/cdk-cached.sh ls` or `scripts/cdk-cached.sh diff -c stacks=MercuryStack`.
+# The app is re-synthesized when its sources or dependencies change, or when the context or
+# profile arguments, AWS_PROFILE or CDK_DEFAULT_ACCOUNT/CDK_DEFAULT_REGION differ from the
+# cached synth.
+set -euo pipefail
+
+cd "$(dirname "$0")/.."
+
+case "${1:-}" in
+    ls | list | diff) ;;
+    *)
+        echo "usage: $0 {ls|diff} [args...]; run cdk directly for other commands" >&2
+        exit 1
+        ;;
+esac
+
+OUTDIR="cdk.out"
+STAMP="${OUTDIR}/.synth-stamp"
+
+# context and profile arguments must reach the synth, not just the cached assembly
+synth_args=()
+args=("$@")
+for ((i = 0; i < ${#args[@]}; i++)); do
+    case "${args[i]}" in
+        -c | --context | --profile) synth_args+=("${args[i]}" "${args[i + 1]:-}") ;;
+        --context=* | --profile=*) synth_args+=("${args[i]}") ;;
+    esac
+done
+
+signature="${AWS_PROFILE:-} ${CDK_DEFAULT_ACCOUNT:-} ${CDK_DEFAULT_REGION:-} ${synth_args[*]:-}"
+sources=(app.py cdk.json requirements.txt lib installables)
+[[ -f cdk.context.json ]] && sources+=(cdk.context.json)
+
+if [[ ! -f "${STAMP}" ]] || [[ "$(cat "${STAMP}")" != "${signature}" ]] ||
+    [[ -n "$(find "${sources[@]}" -newer "${STAMP}" -print -quit)" ]]; then
+    cdk synth --quiet --output "${OUTDIR}" ${synth_args[@]+"${synth_args[@]}"}
+    echo "${signature}" > "${STAMP}"
+fi
+
+exec cdk --app "${OUTDIR}" "$@"